@@ -6,9 +6,12 @@ import logging
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 import os
-from typing import Dict, Optional
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
 
 import httpx
+from apscheduler import AsyncScheduler
+from apscheduler.triggers.interval import IntervalTrigger
 from fastapi import Depends, FastAPI, Form, HTTPException, Query, Request
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
@@ -32,22 +35,57 @@ TPL_DIR = BASE_DIR / "templates"
 STATIC_DIR.mkdir(parents=True, exist_ok=True)
 TPL_DIR.mkdir(parents=True, exist_ok=True)
 
-app = FastAPI(title="Clientes PH (Masiva)")
-app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
-templates = Jinja2Templates(directory=str(TPL_DIR))
-
 SESSION_SECRET = os.getenv("SESSION_SECRET", "cambia-esta-clave")
 READ_USERNAME = os.getenv("READ_USERNAME", "consulta")
 READ_PASSWORD = os.getenv("READ_PASSWORD", "consulta123")
 WRITE_USERNAME = os.getenv("WRITE_USERNAME", "gestion")
 WRITE_PASSWORD = os.getenv("WRITE_PASSWORD", "gestion123")
+ALTA_URL = os.getenv("ALTA_URL", "")
 HEARTBEAT_URL = os.getenv("HEARTBEAT_URL")
 if not HEARTBEAT_URL:
     render_url = os.getenv("RENDER_EXTERNAL_URL", "")
     if render_url:
         HEARTBEAT_URL = render_url.rstrip('/') + "/api/ping"
 HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL_SECONDS", "240"))
-_heartbeat_task: asyncio.Task | None = None
+# Renew the Phantom token at ~80% of its lifetime so requests never wait on it.
+TOKEN_REFRESH_INTERVAL = ph.TOKEN_TTL * 0.8
+_heartbeat_client: httpx.AsyncClient | None = None
+
+
+async def _ping() -> None:
+    if _heartbeat_client is None or not HEARTBEAT_URL:
+        return
+    try:
+        await _heartbeat_client.get(HEARTBEAT_URL)
+    except Exception as exc:
+        logger.debug("heartbeat failed: %s", exc)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _heartbeat_client
+    await ph.startup()
+    _heartbeat_client = httpx.AsyncClient(timeout=10.0)
+    try:
+        async with AsyncScheduler() as scheduler:
+            if HEARTBEAT_URL and HEARTBEAT_INTERVAL > 0:
+                await scheduler.add_schedule(
+                    _ping, IntervalTrigger(seconds=HEARTBEAT_INTERVAL), id="heartbeat"
+                )
+            await scheduler.add_schedule(
+                ph.refresh_token, IntervalTrigger(seconds=TOKEN_REFRESH_INTERVAL), id="ph-token"
+            )
+            await scheduler.start_in_background()
+            yield
+    finally:
+        await _heartbeat_client.aclose()
+        _heartbeat_client = None
+        await ph.shutdown()
+
+
+app = FastAPI(title="Clientes PH (Masiva)", lifespan=lifespan)
+app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
+templates = Jinja2Templates(directory=str(TPL_DIR))
 
 app.add_middleware(
     SessionMiddleware,
@@ -89,37 +127,6 @@ def require_write(auth: Dict[str, str] = Depends(require_auth)) -> Dict[str, str
     return auth
 
 
-async def _heartbeat_loop(url: str, interval: float) -> None:
-    if interval <= 0:
-        return
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        while True:
-            try:
-                await client.get(url)
-            except Exception as exc:
-                logger.debug("heartbeat failed: %s", exc)
-            await asyncio.sleep(interval)
-
-
-@app.on_event("startup")
-async def _on_startup():
-    global _heartbeat_task
-    if HEARTBEAT_URL and HEARTBEAT_INTERVAL > 0:
-        _heartbeat_task = asyncio.create_task(_heartbeat_loop(HEARTBEAT_URL, HEARTBEAT_INTERVAL))
-
-
-@app.on_event("shutdown")
-async def _on_shutdown():
-    global _heartbeat_task
-    if _heartbeat_task:
-        _heartbeat_task.cancel()
-        try:
-            await _heartbeat_task
-        except asyncio.CancelledError:
-            pass
-        _heartbeat_task = None
-
-
 # -----------------------------
 # Rutas HTML
 # -----------------------------
@@ -174,12 +181,19 @@ def ping():
     return {"ok": True}
 
 
+async def _sheet_prefetch() -> Optional[Dict[str, object]]:
+    # Warms the sheet cache and resolves the proposed user while Phantom is
+    # queried, so the name lookup afterwards is served from memory.
+    await tv.load_data_from_sheet()
+    return await tv.obtener_usuario_cic_disponible()
+
+
 @app.get("/api/cliente")
-def api_cliente(
+async def api_cliente(
     request: Request,
     ida: str = Query(..., description="IDA del cliente"),
     auth: Dict[str, str] = Depends(require_auth),
-):
+) -> Dict[str, Any]:
     """
     Devuelve datos del cliente desde Consulta_Masiva_Datos (PH) y
     agrega datos del Sheet:
@@ -196,12 +210,21 @@ def api_cliente(
         raise HTTPException(400, "IDA vacío")
 
     try:
-        data = ph.consultar_y_transformar_masiva(ida)
+        ph_task = asyncio.create_task(ph.consultar_y_transformar_masiva(ida))
+        tasks = [ph_task]
+        if tv is not None:
+            tasks.append(asyncio.create_task(_sheet_prefetch()))
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        if isinstance(results[0], BaseException):
+            raise results[0]
+        # ph hands out its cached dict; copy it before adding the sheet fields.
+        data = dict(results[0])
+        disp = results[1] if len(results) > 1 and not isinstance(results[1], BaseException) else None
 
         match = None
         if tv is not None:
             try:
-                match = tv.encontrar_abonado_por_nombre(data.get("Nombre", ""))
+                match = await tv.encontrar_abonado_por_nombre(data.get("Nombre", ""))
             except Exception:
                 match = None
 
@@ -210,19 +233,14 @@ def api_cliente(
         data["usuario_sheet"] = (match or {}).get("usuario", "")
         data["cic_sheet"] = (match or {}).get("cic", "")
 
-        data["AltaURL"] = os.getenv("ALTA_URL", "")
+        data["AltaURL"] = ALTA_URL
 
         data["UsuarioPropuesto"] = ""
         data["CICPropuesto"] = ""
-        if not data["ya_tiene_usuario"] and tv is not None:
-            try:
-                disp = tv.obtener_usuario_cic_disponible()
-                if disp:
-                    data["UsuarioPropuesto"] = disp.get("usuario", "")
-                    data["CICPropuesto"] = disp.get("cic", "")
-                    data["fila_propuesta"] = disp.get("row_index")
-            except Exception:
-                pass
+        if not data["ya_tiene_usuario"] and disp:
+            data["UsuarioPropuesto"] = disp.get("usuario", "")
+            data["CICPropuesto"] = disp.get("cic", "")
+            data["fila_propuesta"] = disp.get("row_index")
 
         return data
 
@@ -238,11 +256,11 @@ class MarcaPayload(BaseModel):
 
 
 @app.post("/api/marcar_registro")
-def api_marcar_registro(payload: MarcaPayload, auth: Dict[str, str] = Depends(require_write)):
+async def api_marcar_registro(payload: MarcaPayload, auth: Dict[str, str] = Depends(require_write)):
     if tv is None:
         raise HTTPException(status_code=500, detail="Integración con Google Sheets no disponible")
     try:
-        res = tv.marcar_registro_sheet(
+        res = await tv.marcar_registro_sheet(
             usuario=payload.usuario,
             ida=payload.ida,
             nombre=payload.nombre,
@@ -6,21 +6,25 @@ shape expected by the FastAPI endpoints.
 
 from __future__ import annotations
 
+import asyncio
 import json
+import logging
 import os
 import re
 import time
 import unicodedata
-from collections import OrderedDict
 from threading import Lock
 from typing import Any, Dict
 
+from cachetools import TTLCache
 from dotenv import load_dotenv
-import requests
-from requests.adapters import HTTPAdapter
+import httpx
+import orjson
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 PH_URL = os.getenv("PH_URL")
 PH_USER = os.getenv("PH_USER")
 PH_PASS = os.getenv("PH_PASS")
@@ -28,71 +32,101 @@ PH_PASS = os.getenv("PH_PASS")
 REQUEST_TIMEOUT = float(os.getenv("PH_TIMEOUT_SECONDS", "20"))
 CACHE_TTL = float(os.getenv("PH_CACHE_TTL_SECONDS", "180"))
 CACHE_MAX = int(os.getenv("PH_CACHE_MAX_ENTRIES", "64"))
+TOKEN_TTL = 12 * 60
+REFRESH_CONCURRENCY = max(1, int(os.getenv("PH_REFRESH_CONCURRENCY", "4")))
 
-SESSION = requests.Session()
-SESSION.headers.update({"User-Agent": "UsuariosGiga/1.0"})
-_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0)
-SESSION.mount("http://", _adapter)
-SESSION.mount("https://", _adapter)
+_CLIENT: httpx.AsyncClient | None = None
 
 _TOKEN = {"value": "", "ts": 0.0}
+# Indexes of the request variant / payload naming that last worked, tried first.
+_LAST_GOOD_ATTEMPT = 0
+_LAST_GOOD_PAYLOAD = 0
 _CACHE_LOCK = Lock()
-_CACHE: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
+# Entries live for 2 x CACHE_TTL: fresh for the first half, then served stale
+# while a background refresh runs. CACHE_MAX <= 0 means unbounded, as before.
+_CACHE: "TTLCache[str, tuple[float, Dict[str, Any]]]" = TTLCache(
+    maxsize=CACHE_MAX if CACHE_MAX > 0 else float("inf"), ttl=max(CACHE_TTL, 0.0) * 2
+)
+_REFRESHING: set[str] = set()
+# In-flight fetches per IDA, so concurrent misses share one upstream call.
+_INFLIGHT: dict[str, asyncio.Future] = {}
+_REFRESH_TASKS: set[asyncio.Task] = set()
+_REFRESH_SEM = asyncio.Semaphore(REFRESH_CONCURRENCY)
+
+
+def _new_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=REQUEST_TIMEOUT,
+        headers={"User-Agent": "UsuariosGiga/1.0"},
+        http2=True,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=60),
+    )
 
 
-def _json(resp: requests.Response) -> Any:
-    try:
-        return resp.json()
-    except ValueError:
-        text = resp.content.decode("utf-8-sig", errors="replace").strip()
-        return json.loads(text or "{}")
+async def startup() -> None:
+    """Create the shared HTTP client (called from the app lifespan on startup)."""
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = _new_client()
 
 
-def _purge_expired(now: float) -> None:
-    if CACHE_TTL <= 0:
-        _CACHE.clear()
-        return
-    expired = [key for key, (ts, _) in _CACHE.items() if now - ts > CACHE_TTL]
-    for key in expired:
-        _CACHE.pop(key, None)
+async def shutdown() -> None:
+    """Cancel pending fetches and close the shared HTTP client (called from the app lifespan)."""
+    global _CLIENT
+    for task in [*_REFRESH_TASKS, *_INFLIGHT.values()]:
+        task.cancel()
+    if _CLIENT is not None:
+        await _CLIENT.aclose()
+        _CLIENT = None
+
+
+def _client() -> httpx.AsyncClient:
+    # Lazily created for callers outside FastAPI (e.g. the CLI below).
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = _new_client()
+    return _CLIENT
+
+
+def _preferred_order(count: int, first: int) -> list[int]:
+    return [first] + [i for i in range(count) if i != first]
+
+
+def _json(resp: httpx.Response) -> Any:
+    content = resp.content.removeprefix(b"\xef\xbb\xbf").strip()
+    try:
+        return orjson.loads(content or b"{}")
+    except orjson.JSONDecodeError:
+        # Not UTF-8 (orjson only reads UTF-8): decode with the charset the
+        # response declares, e.g. ISO-8859-1, so accented names survive.
+        text = content.decode(resp.encoding or "utf-8", errors="replace")
+        return json.loads(text or "{}")
 
 
-def _cache_get(key: str) -> Dict[str, Any] | None:
+def _cache_get(key: str) -> tuple[float, Dict[str, Any]] | None:
+    """Return ``(stored_at, data)``; data is shared, callers must copy before mutating."""
     if CACHE_TTL <= 0:
         return None
-    now = time.time()
     with _CACHE_LOCK:
-        _purge_expired(now)
-        item = _CACHE.get(key)
-        if not item:
-            return None
-        _CACHE.move_to_end(key)
-        _, data = item
-        return dict(data)
+        return _CACHE.get(key)
 
 
 def _cache_set(key: str, value: Dict[str, Any]) -> None:
     if CACHE_TTL <= 0:
         return
-    now = time.time()
     with _CACHE_LOCK:
-        _purge_expired(now)
-        _CACHE[key] = (now, dict(value))
-        _CACHE.move_to_end(key)
-        while len(_CACHE) > CACHE_MAX > 0:
-            _CACHE.popitem(last=False)
+        _CACHE[key] = (time.monotonic(), value)
 
 
-def _token() -> str:
+async def _token(force: bool = False) -> str:
     if not all([PH_URL, PH_USER, PH_PASS]):
         raise RuntimeError("PH_URL/PH_USER/PH_PASS not configured in .env")
-    now = time.time()
-    if _TOKEN["value"] and now - _TOKEN["ts"] < 12 * 60:
+    now = time.monotonic()
+    if not force and _TOKEN["value"] and now - _TOKEN["ts"] < TOKEN_TTL:
         return _TOKEN["value"]
-    resp = SESSION.get(
+    resp = await _client().get(
         PH_URL,
         params={"action": "autentificar", "api_user": PH_USER, "api_pass": PH_PASS, "JSON": 1},
-        timeout=REQUEST_TIMEOUT,
     )
     resp.raise_for_status()
     token = (_json(resp) or {}).get("token", "")
@@ -103,7 +137,14 @@ def _token() -> str:
     return token
 
 
-def _req_masiva(payload: Dict[str, Any]) -> Any | None:
+async def refresh_token() -> None:
+    """Renew the Phantom token ahead of expiry (run periodically by the app scheduler)."""
+    if all([PH_URL, PH_USER, PH_PASS]):
+        await _token(force=True)
+
+
+async def _req_masiva(payload: Dict[str, Any]) -> Any | None:
+    global _LAST_GOOD_ATTEMPT
     if not PH_URL:
         raise RuntimeError("PH_URL not configured in .env")
     params = {"action": "Consulta_Masiva_Datos", "JSON": 1}
@@ -119,35 +160,40 @@ def _req_masiva(payload: Dict[str, Any]) -> Any | None:
         ),
         ("get", {"params": {**params, **payload}, "headers": {"Accept": "application/json"}}),
     )
-    for method, kwargs in attempts:
+    for index in _preferred_order(len(attempts), _LAST_GOOD_ATTEMPT):
+        method, kwargs = attempts[index]
         try:
-            resp = SESSION.request(method=method, url=PH_URL, timeout=REQUEST_TIMEOUT, **kwargs)
+            resp = await _client().request(method=method, url=PH_URL, **kwargs)
             if resp.status_code == 200:
+                _LAST_GOOD_ATTEMPT = index
                 return _json(resp)
         except Exception:
             continue
     return None
 
 
-def _iter_records(data: Any):
+_RECORD_LIST_KEYS = ("abonados", "Abonados", "data", "Data", "rows", "items", "result")
+
+
+def _extract_records(data: Any) -> list[Dict[str, Any]]:
+    """Return the record list of a response: the first non-empty known list, or the payload itself."""
     if isinstance(data, list):
-        for item in data:
-            if isinstance(item, dict):
-                yield item
-        return
+        return [item for item in data if isinstance(item, dict)]
     if isinstance(data, dict):
-        for key in ("abonados", "Abonados", "data", "Data", "rows", "items", "result"):
+        for key in _RECORD_LIST_KEYS:
             arr = data.get(key)
             if isinstance(arr, list):
-                for item in arr:
-                    if isinstance(item, dict):
-                        yield item
+                recs = [item for item in arr if isinstance(item, dict)]
+                if recs:
+                    return recs
         if any(isinstance(v, (str, int, float)) for v in data.values()):
-            yield data
+            return [data]
+    return []
 
 
-def consulta_masiva_por_id(ida: int | str) -> Dict[str, Any] | None:
-    token = _token()
+async def consulta_masiva_por_id(ida: int | str) -> Dict[str, Any] | None:
+    global _LAST_GOOD_PAYLOAD
+    token = await _token()
     ida_int = int(ida)
     payloads = [
         {"token": token, "ID_Desde": ida_int, "ID_Hasta": ida_int},
@@ -155,27 +201,36 @@ def consulta_masiva_por_id(ida: int | str) -> Dict[str, Any] | None:
         {"token": token, "IDDesde": ida_int, "IDHasta": ida_int},
         {"token": token, "Desde": ida_int, "Hasta": ida_int},
     ]
-    for payload in payloads:
-        data = _req_masiva(payload)
+    for index in _preferred_order(len(payloads), _LAST_GOOD_PAYLOAD):
+        data = await _req_masiva(payloads[index])
         if not data:
             continue
         if isinstance(data, dict) and "code" in data and str(data["code"]) not in {"200", "OK"}:
             continue
-        for rec in _iter_records(data):
-            rid = str(rec.get("ID") or rec.get("IDA") or "")
-            if rid == str(ida_int):
-                return rec
-        for rec in _iter_records(data):
-            return rec
+        recs = _extract_records(data)
+        if not recs:
+            continue
+        by_id = {str(_first(_lower_keys(rec), _ID_KEYS) or ""): rec for rec in reversed(recs)}
+        _LAST_GOOD_PAYLOAD = index
+        return by_id.get(str(ida_int)) or recs[0]
     return None
 
 
+_ACCENT_TBL = str.maketrans("áéíóúüñÁÉÍÓÚÜÑàèìòùÀÈÌÒÙ", "aeiouunAEIOUUNaeiouAEIOU")
+
+
+def _strip_accents(value: str) -> str:
+    value = value.translate(_ACCENT_TBL)
+    if value.isascii():
+        return value
+    # Characters outside the table still go through the NFD decomposition.
+    return "".join(c for c in unicodedata.normalize("NFD", value) if unicodedata.category(c) != "Mn")
+
+
 def _normalize_text(value: str) -> str:
     if value is None:
         return ""
-    return "".join(
-        c for c in unicodedata.normalize("NFD", str(value)) if unicodedata.category(c) != "Mn"
-    ).upper()
+    return _strip_accents(str(value)).upper()
 
 
 _EMAIL_RE = re.compile(r"[A-Z0-9._%+\-]+@[A-Z0-9.\-]+\.[A-Z]{2,}", re.I)
@@ -191,11 +246,36 @@ def _clean_email_text(value: str) -> str:
     return value
 
 
-def extraer_mail(record: Dict[str, Any]) -> str:
-    candidates = []
-    for key in ("Email", "email", "Mail", "MAIL", "E-mail", "UsuarioAutogestion", "Autogestion_User"):
-        if key in record and record[key]:
-            candidates.append(record[key])
+# Candidate record keys, lower-cased; records are probed through _lower_keys().
+_MAIL_KEYS = ("email", "mail", "e-mail", "usuarioautogestion", "autogestion_user")
+_ID_KEYS = ("id", "ida")
+_DNI_KEYS = ("documento", "cuit")
+_PRODUCT_KEYS = ("television", "productos")
+_ESTADO_KEYS = ("estado",)
+
+
+def _lower_keys(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Lower-case the record keys; when keys differ only by case, the first non-empty value wins."""
+    lower: Dict[str, Any] = {}
+    for key, value in record.items():
+        key = str(key).lower()
+        if not lower.get(key):
+            lower[key] = value
+    return lower
+
+
+def _first(lower: Dict[str, Any], keys: tuple[str, ...]) -> Any:
+    for key in keys:
+        value = lower.get(key)
+        if value:
+            return value
+    return None
+
+
+def extraer_mail(record: Dict[str, Any], lower: Dict[str, Any] | None = None) -> str:
+    if lower is None:
+        lower = _lower_keys(record)
+    candidates = [lower[key] for key in _MAIL_KEYS if lower.get(key)]
     if not candidates:
         candidates = [v for v in record.values() if isinstance(v, str)]
     for value in candidates:
@@ -205,13 +285,17 @@ def extraer_mail(record: Dict[str, Any]) -> str:
     return ""
 
 
+_PROD_RE = re.compile(r"(?P<tv>SERVICIO TV|BASICO|BASIC)|(?P<hbo>HBO)|(?P<pf>PACK FUTB|FUTBOL|DEPORTIVO)")
+_PROD_FLAGS = {"tv": "TV", "hbo": "HBO", "pf": "Pack Futbol"}
+
+
 def _parse_product_flags(productos: str) -> Dict[str, bool]:
-    items = [p.strip() for p in (productos or "").split(";") if p.strip()]
-    normalized = [_normalize_text(p) for p in items]
-    has_tv = any("SERVICIO TV" in p or "BASICO" in p or "BASIC" in p for p in normalized)
-    has_hbo = any("HBO" in p for p in normalized)
-    has_pf = any("PACK FUTB" in p or "FUTBOL" in p or "DEPORTIVO" in p for p in normalized)
-    return {"TV": has_tv, "HBO": has_hbo, "Pack Futbol": has_pf}
+    flags = {"TV": False, "HBO": False, "Pack Futbol": False}
+    # No pattern contains ";", so scanning the whole list at once is equivalent
+    # to matching each product separately.
+    for match in _PROD_RE.finditer(_normalize_text(productos or "")):
+        flags[_PROD_FLAGS[match.lastgroup]] = True
+    return flags
 
 
 def _estado_code(value: str) -> str:
@@ -226,17 +310,18 @@ def _estado_code(value: str) -> str:
 
 
 def transformar_desde_masiva(record: Dict[str, Any]) -> Dict[str, Any]:
-    nombre_base = record.get("RS") or f"{record.get('Apellido', '')} {record.get('Nombre', '')}"
+    lower = _lower_keys(record)
+    nombre_base = lower.get("rs") or f"{lower.get('apellido', '')} {lower.get('nombre', '')}"
     nombre_limpio = " ".join(str(nombre_base).replace(",", " ").split())
-    dni = record.get("Documento") or record.get("CUIT") or ""
-    mail = record.get("Email") or extraer_mail(record)
+    dni = _first(lower, _DNI_KEYS) or ""
+    mail = lower.get("email") or extraer_mail(record, lower)
     iniciales = "".join(word[:1] for word in nombre_limpio.split() if word).lower()
     contrasena = f"{iniciales}{dni}".strip()
-    flags = _parse_product_flags(record.get("Television") or record.get("Productos") or "")
-    estado_txt = (record.get("Estado") or record.get("estado") or "").strip()
+    flags = _parse_product_flags(_first(lower, _PRODUCT_KEYS) or "")
+    estado_txt = (_first(lower, _ESTADO_KEYS) or "").strip()
     estado_code = _estado_code(estado_txt)
     return {
-        "ID": str(record.get("ID") or record.get("IDA") or ""),
+        "ID": str(_first(lower, _ID_KEYS) or ""),
         "Nombre": nombre_limpio,
         "DNI": str(dni) if dni is not None else "",
         "Mail": (mail or "").strip(),
@@ -250,24 +335,75 @@ def transformar_desde_masiva(record: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
-def consultar_y_transformar_masiva(ida: int | str) -> Dict[str, Any]:
-    ida_int = int(ida)
-    cache_key = str(ida_int)
-    cached = _cache_get(cache_key)
-    if cached is not None:
-        return cached
-    record = consulta_masiva_por_id(ida_int)
+async def _fetch_and_cache(ida_int: int) -> Dict[str, Any]:
+    record = await consulta_masiva_por_id(ida_int)
     if not record:
         raise RuntimeError("Consulta_Masiva_Datos did not return data")
     data = transformar_desde_masiva(record)
-    _cache_set(cache_key, data)
+    _cache_set(str(ida_int), data)
     return data
 
 
+def _fetch_coalesced(ida_int: int) -> asyncio.Future:
+    """Return the pending fetch for this IDA, starting one if there is none."""
+    key = str(ida_int)
+    fut = _INFLIGHT.get(key)
+    if fut is None:
+        fut = asyncio.create_task(_fetch_and_cache(ida_int))
+        _INFLIGHT[key] = fut
+
+        def _done(done: asyncio.Future) -> None:
+            if _INFLIGHT.get(key) is done:
+                _INFLIGHT.pop(key, None)
+
+        fut.add_done_callback(_done)
+    return fut
+
+
+async def _refresh_bg(ida_int: int) -> None:
+    try:
+        async with _REFRESH_SEM:
+            await asyncio.shield(_fetch_coalesced(ida_int))
+    except Exception as exc:
+        # Keep serving the stale entry; the next hit will retry.
+        logger.debug("background refresh of %s failed: %s", ida_int, exc)
+    finally:
+        _REFRESHING.discard(str(ida_int))
+
+
+def _schedule_refresh(ida_int: int) -> None:
+    key = str(ida_int)
+    if key in _REFRESHING:
+        return
+    _REFRESHING.add(key)
+    task = asyncio.create_task(_refresh_bg(ida_int))
+    _REFRESH_TASKS.add(task)
+    task.add_done_callback(_REFRESH_TASKS.discard)
+
+
+async def consultar_y_transformar_masiva(ida: int | str) -> Dict[str, Any]:
+    ida_int = int(ida)
+    cached = _cache_get(str(ida_int))
+    if cached is not None:
+        stored_at, data = cached
+        if time.monotonic() - stored_at > CACHE_TTL:
+            _schedule_refresh(ida_int)
+        return data
+    # shield: a cancelled caller must not cancel the fetch other callers await.
+    return await asyncio.shield(_fetch_coalesced(ida_int))
+
+
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--ida", required=True)
     args = parser.parse_args()
-    print(json.dumps(consultar_y_transformar_masiva(args.ida), ensure_ascii=False, indent=2))
+
+    async def _main() -> Dict[str, Any]:
+        try:
+            return await consultar_y_transformar_masiva(args.ida)
+        finally:
+            await shutdown()
+
+    print(json.dumps(asyncio.run(_main()), ensure_ascii=False, indent=2))
@@ -1,28 +1,40 @@
 ﻿"""Google Sheets helpers for the GigaredPlay workflow."""
 
+import asyncio
 import base64
+import logging
 import os
 import re
 import tempfile
 import time
 import unicodedata
 from collections import Counter
-from copy import deepcopy
+from functools import lru_cache
 from pathlib import Path
 from threading import Lock
 from typing import Optional, Dict, Any, List
 
-import gspread
+import gspread_asyncio
+from gspread.utils import ValueInputOption
 from google.oauth2.service_account import Credentials
 
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID", "1MS-5SwNBjACZEGie2cOYSu5KLc2YmhmtRfsjis7nuFQ")
 WORKSHEET_INDEX = int(os.getenv("WORKSHEET_INDEX", "0"))
 SERVICE_ACCOUNT_FILE = os.getenv("SERVICE_ACCOUNT_FILE", "usuariosgigaredplay-eb5981b62919.json")
+SERVICE_ACCOUNT_JSON = os.getenv("SERVICE_ACCOUNT_JSON", "").strip()
 SHEET_CACHE_TTL = float(os.getenv("SHEET_CACHE_TTL_SECONDS", "45"))
+SHEET_TIMEOUT = float(os.getenv("SHEET_TIMEOUT_SECONDS", "20"))
+
+logger = logging.getLogger(__name__)
 
 _sheet_cache_lock = Lock()
 _sheet_cache: Dict[str, tuple[float, Any]] = {}
 _service_account_path: Optional[str] = None
+_agcm: Optional["_SheetsClientManager"] = None
+_ws: Optional[gspread_asyncio.AsyncioGspreadWorksheet] = None
+_ws_lock = asyncio.Lock()
+# Full-sheet download in progress, shared by concurrent cache misses.
+_matrix_fetch: Optional[asyncio.Task] = None
 
 
 def _resolve_service_account_file() -> str:
@@ -31,7 +43,7 @@ def _resolve_service_account_file() -> str:
     if _service_account_path:
         return _service_account_path
 
-    json_env = os.getenv('SERVICE_ACCOUNT_JSON', '').strip()
+    json_env = SERVICE_ACCOUNT_JSON
     if json_env:
         try:
             decoded = base64.b64decode(json_env).decode('utf-8')
@@ -49,6 +61,7 @@ def _resolve_service_account_file() -> str:
 
 
 def _cache_get(key: str):
+    """Return the cached value as-is; callers must treat it as read-only."""
     if SHEET_CACHE_TTL <= 0:
         return None
     now = time.time()
@@ -60,7 +73,7 @@ def _cache_get(key: str):
         if now - ts > SHEET_CACHE_TTL:
             _sheet_cache.pop(key, None)
             return None
-        return deepcopy(value)
+        return value
 
 
 def _cache_set(key: str, value: Any) -> None:
@@ -68,7 +81,7 @@ def _cache_set(key: str, value: Any) -> None:
         return
     now = time.time()
     with _sheet_cache_lock:
-        _sheet_cache[key] = (now, deepcopy(value))
+        _sheet_cache[key] = (now, value)
 
 
 def _cache_clear() -> None:
@@ -76,53 +89,148 @@ def _cache_clear() -> None:
         _sheet_cache.clear()
 
 
+def _freeze_matrix(values: List[List[str]]) -> tuple:
+    """Return the sheet matrix as tuples so it can be shared from the cache."""
+    return tuple(tuple(row) for row in values)
+
+
 # Normalisation helpers
 
+_ACCENT_TBL = str.maketrans("áéíóúüñÁÉÍÓÚÜÑàèìòùÀÈÌÒÙ", "aeiouunAEIOUUNaeiouAEIOU")
+
+
+def _strip_accents(value: str) -> str:
+    value = value.translate(_ACCENT_TBL)
+    if value.isascii():
+        return value
+    return "".join(c for c in unicodedata.normalize("NFD", value) if unicodedata.category(c) != "Mn")
+
+
 def _norm(value: str) -> str:
     return (value or "").strip()
 
 
+@lru_cache(maxsize=8192)
 def _normkey(value: str) -> str:
     if not value:
         return ""
-    value = "".join(c for c in unicodedata.normalize("NFD", str(value)) if unicodedata.category(c) != "Mn")
-    value = value.lower()
+    value = _strip_accents(str(value)).lower()
     return re.sub(r"[\s_\-]+", "", value)
 
 
-def _name_signature(value: str) -> Counter:
-    """Return a token multiset for a name (accent insensitive)."""
+def _name_signature(value: str) -> tuple:
+    """Return a hashable token multiset for a name (accent insensitive)."""
     if not value:
-        return Counter()
-    base = "".join(c for c in unicodedata.normalize("NFD", str(value)) if unicodedata.category(c) != "Mn").upper()
+        return ()
+    base = _strip_accents(str(value)).upper()
     tokens = re.findall(r"[A-Z0-9]+", base)
-    return Counter(tokens)
+    return tuple(sorted(Counter(tokens).items()))
+
+
+@lru_cache(maxsize=1024)
+def _query_signature(value: str) -> tuple:
+    """Memoised _name_signature for lookup queries, which repeat across requests.
+
+    Row names are signed once per sheet load, so they are not worth caching.
+    """
+    return _name_signature(value)
 
 
-def _open_ws():
+def _get_creds() -> Credentials:
     scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-    creds = Credentials.from_service_account_file(_resolve_service_account_file(), scopes=scopes)
-    client = gspread.authorize(creds)
-    ss = client.open_by_key(SPREADSHEET_ID)
-    return ss.get_worksheet(WORKSHEET_INDEX)
+    return Credentials.from_service_account_file(_resolve_service_account_file(), scopes=scopes)
+
+
+class _SheetsClientManager(gspread_asyncio.AsyncioGspreadClientManager):
+    """Client manager that surfaces Sheets errors instead of retrying forever.
+
+    The library default sleeps and retries 5xx/429 and connection errors without
+    limit, which would hang /api/cliente during an outage. Raising lets callers
+    fall back as they did with plain gspread.
+    """
+
+    async def handle_gspread_error(self, e, method, args, kwargs):
+        logger.warning("Sheets API error in %s: %s", method.__name__, e)
+        raise e
+
+    async def handle_requests_error(self, e, method, args, kwargs):
+        logger.warning("Sheets request error in %s: %s", method.__name__, e)
+        raise e
+
+
+async def _open_ws() -> gspread_asyncio.AsyncioGspreadWorksheet:
+    """Return the shared worksheet handle, opening it on first use."""
+    global _agcm, _ws
+    async with _ws_lock:
+        if _ws is None:
+            if _agcm is None:
+                # No client-side pacing: the app makes a handful of calls per
+                # request, far below the Sheets quota.
+                _agcm = _SheetsClientManager(_get_creds, gspread_delay=0, gspread_timeout=SHEET_TIMEOUT)
+            client = await _agcm.authorize()
+            ss = await client.open_by_key(SPREADSHEET_ID)
+            _ws = await ss.get_worksheet(WORKSHEET_INDEX)
+        return _ws
+
+
+async def _download_matrix() -> tuple:
+    ws = await _open_ws()
+    values = _freeze_matrix(await ws.get_values())
+    _cache_set("matrix", values)
+    return values
 
 
-def load_data_from_sheet(force_refresh: bool = False) -> List[Dict[str, Any]]:
-    """Return sheet rows as a list of dicts using a best effort header selection."""
+async def _fetch_matrix() -> tuple:
+    """Download the full matrix, joining a download that is already in flight.
+
+    Sheets calls are serialised by the client manager, so without this a cold
+    burst of N requests would queue N whole-sheet downloads.
+    """
+    global _matrix_fetch
+    if _matrix_fetch is None:
+        _matrix_fetch = asyncio.create_task(_download_matrix())
+
+        def _done(task: asyncio.Task) -> None:
+            global _matrix_fetch
+            if _matrix_fetch is task:
+                _matrix_fetch = None
+
+        _matrix_fetch.add_done_callback(_done)
+    # shield: a cancelled caller must not abort the download others await.
+    return await asyncio.shield(_matrix_fetch)
+
+
+_COLUMN_CANDIDATES: Dict[str, List[str]] = {
+    "nombre": ["Nombre", "Razon Social", "Razon_Social", "Cliente", "Titular"],
+    "abonado": ["Gigared", "Abonado", "Numero", "Nro Abonado"],
+    "cic": ["CIC"],
+    "usuario": ["Usuario", "Usuario GP", "Usuario GigaredPlay", "User"],
+}
+
+
+async def _load_sheet(force_refresh: bool = False) -> tuple[List[Dict[str, Any]], Dict[tuple, Dict[str, Any]]]:
+    """Return ``(records, sig_index)``, building both in one pass over the matrix.
+
+    The parsed result is cached with the matrix it came from and reused for as
+    long as that same matrix is cached, so warm lookups skip the rebuild.
+    """
     values = None if force_refresh else _cache_get("matrix")
     if values is None:
-        ws = _open_ws()
-        values = ws.get_all_values()
-        _cache_set("matrix", values)
+        values = await _fetch_matrix()
+    # Callers that joined the same download reuse the first caller's parse.
+    parsed = _cache_get("parsed")
+    if parsed is not None and parsed[0] is values:
+        return parsed[1], parsed[2]
     if not values:
-        return []
+        return [], {}
 
     # Pick a header row within the first five lines (prefer one containing "CIC").
     header_index = 0
     best_nonempty = -1
     for idx, row in enumerate(values[:5]):
-        nonempty = sum(1 for cell in row if _norm(cell))
-        if any(_norm(cell).upper() == "CIC" for cell in row):
+        cells = list(map(str.strip, row))
+        nonempty = len(cells) - cells.count("")
+        if "CIC" in map(str.upper, cells):
             header_index = idx
             break
         if nonempty > best_nonempty:
@@ -142,22 +250,52 @@ def load_data_from_sheet(force_refresh: bool = False) -> List[Dict[str, Any]]:
             seen[name] = 1
         headers.append(name)
 
+    cols = _resolve_columns(headers)
+    idx_nombre = cols.get("nombre")
+    idx_abonado = cols.get("abonado")
+    idx_cic = cols.get("cic")
+    idx_usuario = cols.get("usuario")
+
+    width = len(headers)
     records: List[Dict[str, Any]] = []
+    sig_index: Dict[tuple, Dict[str, Any]] = {}
     for row in values[header_index + 1 :]:
-        if not any(_norm(cell) for cell in row):
+        cells = list(map(str.strip, row))
+        if not any(cells):
             continue
-        record = {headers[j]: _norm(row[j]) if j < len(row) else "" for j in range(len(headers))}
+        if len(cells) < width:
+            cells.extend([""] * (width - len(cells)))
+        record = dict(zip(headers, cells))
         records.append(record)
-
-    _cache_set("records", records)
+        if idx_nombre is None:
+            continue
+        # Index rows by name signature; the first row with a given signature wins.
+        sig_key = _name_signature(cells[idx_nombre])
+        if sig_key not in sig_index:
+            sig_index[sig_key] = {
+                "abonado": cells[idx_abonado] if idx_abonado is not None else "",
+                "row": record,
+                "cic": cells[idx_cic] if idx_cic is not None else "",
+                "usuario": cells[idx_usuario] if idx_usuario is not None else "",
+            }
+
+    _cache_set("parsed", (values, records, sig_index))
+    return records, sig_index
+
+
+async def load_data_from_sheet(force_refresh: bool = False) -> List[Dict[str, Any]]:
+    """Return sheet rows as a list of dicts using a best effort header selection.
+
+    The list is shared with the cache; treat it as read-only.
+    """
+    records, _ = await _load_sheet(force_refresh)
     return records
 
 
-def _find_key(row: Dict[str, Any], candidates: List[str]) -> Optional[str]:
-    """Return the actual key in a row matching any of the candidate names."""
-    if not row:
+def _find_key(normalised: Dict[str, str], candidates: List[str]) -> Optional[str]:
+    """Return the real key in a header map matching any of the candidate names."""
+    if not normalised:
         return None
-    normalised = {_normkey(key): key for key in row.keys()}
     desired = [_normkey(c) for c in candidates]
     for cand in desired:
         if cand in normalised:
@@ -169,40 +307,33 @@ def _find_key(row: Dict[str, Any], candidates: List[str]) -> Optional[str]:
     return None
 
 
-def _get_abonado_num(row: Dict[str, Any]) -> str:
-    key = _find_key(row, ["Gigared", "Abonado", "Numero", "Nro Abonado"])
-    if not key:
-        return ""
-    value = row.get(key, "").strip()
-    return value
+def _resolve_columns(headers: List[str]) -> Dict[str, int]:
+    """Return the column index of each field in _COLUMN_CANDIDATES found in the headers."""
+    normalised = {_normkey(header): header for header in headers}
+    positions = {header: j for j, header in enumerate(headers)}
+    cols: Dict[str, int] = {}
+    for field, candidates in _COLUMN_CANDIDATES.items():
+        key = _find_key(normalised, candidates)
+        if key is not None:
+            cols[field] = positions[key]
+    return cols
 
 
-def encontrar_abonado_por_nombre(nombre_busqueda: str) -> Optional[Dict[str, Any]]:
+async def encontrar_abonado_por_nombre(nombre_busqueda: str) -> Optional[Dict[str, Any]]:
     """Return sheet metadata for a client whose name tokens match exactly."""
-    rows = load_data_from_sheet()
-    signature_query = _name_signature(nombre_busqueda)
-    for row in rows:
-        key_nombre = _find_key(row, ["Nombre", "Razon Social", "Razon_Social", "Cliente", "Titular"])
-        if not key_nombre:
-            continue
-        signature_row = _name_signature(row.get(key_nombre, ""))
-        if signature_row == signature_query:
-            abonado = _get_abonado_num(row)
-            key_cic = _find_key(row, ["CIC"])
-            cic = str(row.get(key_cic, "")).strip() if key_cic else ""
-            key_usuario = _find_key(row, ["Usuario", "Usuario GP", "Usuario GigaredPlay", "User"])
-            usuario = str(row.get(key_usuario, "")).strip() if key_usuario else ""
-            return {"abonado": abonado, "row": row, "cic": cic, "usuario": usuario}
-    return None
+    _, sig_index = await _load_sheet()
+    return sig_index.get(_query_signature(nombre_busqueda or ""))
 
 
-def obtener_usuario_cic_disponible() -> Optional[Dict[str, Any]]:
+async def obtener_usuario_cic_disponible() -> Optional[Dict[str, Any]]:
     """Return the first available user ("Registrado" == "no") with columns B-D."""
-    values = _cache_get("matrix")
+    # Reuse the full matrix when it is cached; otherwise fetch just B:D, which is
+    # all this lookup needs. Column positions are resolved by header either way.
+    values = _cache_get("matrix") or _cache_get("bd_matrix")
     if values is None:
-        ws = _open_ws()
-        values = ws.get_all_values()
-        _cache_set("matrix", values)
+        ws = await _open_ws()
+        values = _freeze_matrix(await ws.get("B:D"))
+        _cache_set("bd_matrix", values)
     if not values or len(values) < 2:
         return None
 
@@ -236,48 +367,55 @@ def obtener_usuario_cic_disponible() -> Optional[Dict[str, Any]]:
     return None
 
 
-def _open_ws_rw():
-    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-    creds = Credentials.from_service_account_file(_resolve_service_account_file(), scopes=scopes)
-    client = gspread.authorize(creds)
-    ss = client.open_by_key(SPREADSHEET_ID)
-    return ss.get_worksheet(WORKSHEET_INDEX)
-
-
-def marcar_registro_sheet(usuario: str, ida: str, nombre: str, row_index: Optional[int] = None) -> Dict[str, Any]:
+async def marcar_registro_sheet(usuario: str, ida: str, nombre: str, row_index: Optional[int] = None) -> Dict[str, Any]:
     """Mark the sheet as processed for the given user and invalidate caches."""
-    ws = _open_ws_rw()
+    ws = await _open_ws()
 
     target_row = None
     if row_index and row_index >= 2:
         target_row = int(row_index)
     else:
-        col_usuario = ws.col_values(3)
         usuario_norm = (usuario or "").strip()
-        for idx, value in enumerate(col_usuario, start=1):
-            if idx == 1:
-                continue
-            if (value or "").strip() == usuario_norm:
-                target_row = idx
-                break
+        # Try the cached matrix first; only hit the API when the user is not there.
+        values = _cache_get("matrix")
+        if values:
+            for idx, row in enumerate(values[1:], start=2):
+                if (row[2] if len(row) > 2 else "").strip() == usuario_norm:
+                    target_row = idx
+                    break
+        if not target_row:
+            col_usuario = await ws.col_values(3)
+            for idx, value in enumerate(col_usuario, start=1):
+                if idx == 1:
+                    continue
+                if (value or "").strip() == usuario_norm:
+                    target_row = idx
+                    break
 
     if not target_row:
         raise ValueError(f"No se encontro la fila del usuario '{usuario}'")
 
-    ws.update_cell(target_row, 4, "Mail")
-    ws.update_cell(target_row, 6, str(ida or ""))
-    ws.update_cell(target_row, 7, str(nombre or ""))
+    # One values_batch_update for the three cells; the worksheet qualifies the
+    # ranges with its title, so a non-zero WORKSHEET_INDEX still writes its own tab.
+    updates = ((f"D{target_row}", "Mail"), (f"F{target_row}", str(ida or "")), (f"G{target_row}", str(nombre or "")))
+    await ws.batch_update(
+        [{"range": cell, "values": [[value]]} for cell, value in updates],
+        value_input_option=ValueInputOption.user_entered,
+    )
 
     a1_range = f"A{target_row}:J{target_row}"
-    ws.format(a1_range, {"textFormat": {"foregroundColor": {"red": 0, "green": 0, "blue": 0}}})
+    await ws.format(a1_range, {"textFormat": {"foregroundColor": {"red": 0, "green": 0, "blue": 0}}})
 
     _cache_clear()
     return {"ok": True, "row": target_row, "usuario": usuario, "ida": ida, "nombre": nombre}
 
 
 if __name__ == "__main__":
-    rows = load_data_from_sheet()
-    print(f"Filas leidas: {len(rows)}")
-    disp = obtener_usuario_cic_disponible()
-    print("Primer disponible:", disp)
+    async def _main() -> None:
+        rows = await load_data_from_sheet()
+        print(f"Filas leidas: {len(rows)}")
+        disp = await obtener_usuario_cic_disponible()
+        print("Primer disponible:", disp)
+
+    asyncio.run(_main())
 